@@ -1,7 +1,7 @@
 #![allow(dead_code)] // For some reason we must add this
-use std::{env::args, fs::File, io::BufWriter, path::Path};
+use std::{cell::RefCell, env::args, fs::File, io::{stdin, stdout, BufRead, BufWriter, Read, Write}, panic, path::Path};
 
-use inkwell::context::Context;
+use inkwell::{context::Context, memory_buffer::MemoryBuffer, module::Module};
 use jvlm::{compile, options::JvlmCompileOptions};
 
 pub(crate) mod java_types;
@@ -9,14 +9,63 @@ mod classfile;
 
 fn main() {
     let args = &args().collect::<Vec<_>>();
+    if args[1] == "--serve" {
+        serve();
+        return;
+    }
     let input = Path::new(&args[1]);
     let output = Path::new(&args[2]);
 
     println!("Reading {}", input.display());
 
+    if input == Path::new("-") {
+        // Bitcode can also be piped in, as in `clang -emit-llvm -c test.c -o - | jvlm - test.jar`
+        let mut bitcode = Vec::new();
+        stdin().read_to_end(&mut bitcode).unwrap();
+        let ctx = Context::create();
+        let buffer = MemoryBuffer::create_from_memory_range_copy(&bitcode, "stdin");
+        compile_module(Module::parse_bitcode_from_buffer(&buffer, &ctx).unwrap(), output);
+    } else {
+        compile_file(input, output);
+    }
+}
+
+fn compile_file(input: &Path, output: &Path) {
     let ctx = Context::create();
-    let input_bitcode = inkwell::module::Module::parse_bitcode_from_path(input, &ctx).unwrap();
-    
+    compile_module(Module::parse_bitcode_from_path(input, &ctx).unwrap(), output);
+}
+
+fn compile_module(module: Module, output: &Path) {
     let output = BufWriter::new(File::create(output).unwrap());
-    compile(input_bitcode, output, JvlmCompileOptions::default());
-}
\ No newline at end of file
+    compile(module, output, JvlmCompileOptions::default());
+}
+
+thread_local! {
+    static LAST_PANIC: RefCell<String> = RefCell::new(String::new());
+}
+
+/// Keeps compiling files until stdin is closed. Each line of stdin should be a job in the form of
+/// `<input>\t<output>`. Once a job is done, either `ok` or `error <n>` is written to stdout as a line.
+/// In case of an error, the line is followed by `n` bytes of error message.
+///
+/// This is used by the test manager, so it doesn't need to start a new process for every test.
+fn serve() {
+    // Panics are reported back over stdout instead
+    panic::set_hook(Box::new(|info| LAST_PANIC.set(info.to_string())));
+
+    let mut out = stdout().lock();
+    for job in stdin().lock().lines() {
+        let job = job.unwrap();
+        let (input, output) = job.split_once('\t').expect("Expected job in the form of <input>\\t<output>");
+
+        match panic::catch_unwind(|| compile_file(Path::new(input), Path::new(output))) {
+            Ok(()) => writeln!(out, "ok").unwrap(),
+            Err(_) => {
+                let message = LAST_PANIC.take();
+                writeln!(out, "error {}", message.len()).unwrap();
+                out.write_all(message.as_bytes()).unwrap();
+            }
+        }
+        out.flush().unwrap();
+    }
+}
@@ -1,17 +1,26 @@
 #!/bin/env python
 
 from abc import ABC, abstractmethod
-from collections.abc import Iterable, Iterator
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
+from functools import cached_property
 from pathlib import Path
-import glob
+import hashlib
+import json
 import re
-from typing import Callable, Literal, Protocol, TypeVar, overload, override
+import select
+import selectors
+from typing import Callable, Generic, Literal, Protocol, TypeVar, overload, override
 import subprocess
 import os
 import shutil
 import sys
+import tempfile
+import threading
+import time
 import typing
 from zipfile import ZipFile
 
@@ -21,11 +30,14 @@ JSHELL = "jshell"
 CLANG = "clang"
 CARGO = "cargo"
 CODEGEN_BACKEND = mainDir / "../target/debug/librustc_codegen_jvlm.so"
+# Each jshell session is two JVMs (the tool and its execution engine), so only a few run at the same time.
+# Running too many would also skew the wall-clock expect_timeout checks
+JSHELL_JOBS = min(4, os.cpu_count() or 1)
 
-def compileRust(input: Path):
+def compileRust(input: Path) -> None:
 	print(f"Rust: Compiling {input}")
 	r = subprocess.call([
-		shutil.which(CARGO),
+		shutil.which(CARGO) or CARGO,
 		"build",
 		"--release"
 	], env={
@@ -73,6 +85,21 @@ class StatusCodeFailure(Failure):
 	def full_err(self) -> str:
 		return f"Command {self.cmd} failed with status code {self.code}.\nStderr:\n{self.stderr.decode(errors="ignore").replace("\n","\n  ")}\nStdout:\n{self.stdout.decode(errors="ignore").replace("\n","\n  ")}."
 @dataclass
+class UnsupportedFailure(Failure):
+	what: str
+	@override
+	def short_err(self) -> str:
+		return f"{self.what} is not supported yet"
+@dataclass
+class CodegenFailure(Failure):
+	message: str
+	@override
+	def short_err(self) -> str:
+		return f"Codegen failed: {self.message.splitlines()[-1] if self.message else ""}"
+	@override
+	def full_err(self) -> str:
+		return f"Codegen failed:\n  {self.message.replace("\n","\n  ")}"
+@dataclass
 class CompileFailure(Failure):
 	lang_name: str
 	segment: str
@@ -96,30 +123,317 @@ class TestFailure(Failure):
 		return f"Test failure {self.lang_name}/{self.segment}: {self.inner.full_err()}"
 
 @overload
-def exec(args: list[str | Path], return_output: Literal[True], cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None) -> Failure | str:
+def exec(args: Sequence[str | Path], return_output: Literal[True], cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None, forward_stderr: bool = False) -> Failure | str:
 	...
 @overload
-def exec(args: list[str | Path], return_output: Literal[False] = False, cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None) -> Failure | None:
+def exec(args: Sequence[str | Path], return_output: Literal[False] = False, cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None, forward_stderr: bool = False) -> Failure | None:
 	...
-def exec(args: list[str | Path], return_output: bool = False, cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None) -> Failure | str | None:
-	try:
-		r = subprocess.run(args, cwd=cwd, timeout=timeout, capture_output=True, input=(input.encode() if input is not None else None))
-		if r.returncode != 0:
-			return StatusCodeFailure(str(args[0]), r.returncode, r.stdout, r.stderr)
-		if return_output:
-			return r.stdout.decode(errors="replace") + r.stderr.decode(errors="replace")
-		else:
+def exec(args: Sequence[str | Path], return_output: bool = False, cwd: str | bytes | os.PathLike[str] | os.PathLike[bytes] | None = None, input: str | None = None, timeout: float | None = None, forward_stderr: bool = False) -> Failure | str | None:
+	"""
+	Runs a command, returning a Failure if it doesn't succeed. With return_output, the output of the command is
+	returned, which includes stderr unless forward_stderr is set. forward_stderr sends stderr straight to our own
+	stderr instead of capturing it.
+	"""
+	deadline = None if timeout is None else time.monotonic() + timeout
+	# If the output isn't returned, stdout is only ever used in error messages. Our tools report errors
+	# over stderr, so stdout can be thrown away without reading it
+	with subprocess.Popen(args, cwd=cwd, stdin=(subprocess.PIPE if input is not None else None), stdout=(subprocess.PIPE if return_output else subprocess.DEVNULL), stderr=(None if forward_stderr else subprocess.PIPE)) as proc:
+		# Output is read straight into growing buffers, which are only turned into bytes when
+		# they're actually needed
+		stdout = bytearray()
+		stderr = bytearray()
+		outputs: dict[int, bytearray] = {}
+		if proc.stderr is not None:
+			outputs[proc.stderr.fileno()] = stderr
+		if proc.stdout is not None:
+			outputs[proc.stdout.fileno()] = stdout
+		to_write = memoryview(input.encode() if input is not None else b"")
+		with selectors.DefaultSelector() as selector:
+			for fd in outputs:
+				_ = selector.register(fd, selectors.EVENT_READ)
+			if proc.stdin is not None:
+				if len(to_write) > 0:
+					_ = selector.register(proc.stdin.fileno(), selectors.EVENT_WRITE)
+				else:
+					proc.stdin.close()
+
+			while len(selector.get_map()) > 0:
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					proc.kill()
+					return TimeoutFailure(str(args[0]), -1 if timeout is None else timeout)
+				for (key, _) in selector.select(remaining):
+					if key.fd in outputs:
+						chunk = os.read(key.fd, 65536)
+						if len(chunk) > 0:
+							outputs[key.fd] += chunk
+						else:
+							_ = selector.unregister(key.fd)
+					else:
+						assert proc.stdin is not None
+						try:
+							to_write = to_write[os.write(key.fd, to_write[:select.PIPE_BUF]):]
+						except BrokenPipeError:
+							to_write = to_write[:0]
+						if len(to_write) == 0:
+							_ = selector.unregister(key.fd)
+							proc.stdin.close()
+
+		try:
+			returncode = proc.wait(timeout=(None if deadline is None else max(0, deadline - time.monotonic())))
+		except subprocess.TimeoutExpired:
+			proc.kill()
+			return TimeoutFailure(str(args[0]), -1 if timeout is None else timeout)
+
+	if returncode != 0:
+		return StatusCodeFailure(str(args[0]), returncode, bytes(stdout), bytes(stderr))
+	if return_output:
+		return stdout.decode(errors="replace") + stderr.decode(errors="replace")
+	else:
+		return None
+
+class Session(Protocol):
+	def is_alive(self) -> bool: ...
+	def close(self) -> None: ...
+
+S = TypeVar("S", bound=Session)
+
+class SessionPool(Generic[S]):
+	"""
+	Hands out long-lived sessions to whichever thread needs one, so that they only need to start up once per
+	thread instead of once per test. Sessions that died while in use are not handed out again.
+	"""
+	start: Callable[[], S]
+	lock: threading.Lock
+	idle: list[S]
+
+	def __init__(self, start: Callable[[], S]) -> None:
+		self.start = start
+		self.lock = threading.Lock()
+		self.idle = []
+
+	@contextmanager
+	def session(self) -> Iterator[S]:
+		with self.lock:
+			session = self.idle.pop() if len(self.idle) > 0 else None
+		if session is None:
+			session = self.start()
+		try:
+			yield session
+		finally:
+			if session.is_alive():
+				with self.lock:
+					self.idle.append(session)
+
+	def close(self) -> None:
+		with self.lock:
+			for session in self.idle:
+				session.close()
+			self.idle.clear()
+
+class CodegenServer:
+	"""
+	A long-lived `jvlm --serve` process, which compiles bitcode into jars as requested over stdin.
+	"""
+	binary: Path
+	proc: subprocess.Popen[bytes]
+	stderr: typing.IO[bytes]
+
+	def __init__(self, binary: Path) -> None:
+		self.binary = binary
+		# Panics are reported over stdout, stderr only matters if the codegen dies without unwinding (an LLVM
+		# fatal error, a segfault, ...). It goes to a file, so nothing needs to keep reading it
+		self.stderr = tempfile.TemporaryFile()
+		self.proc = subprocess.Popen([binary, "--serve"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr)
+
+	def compile(self, input: Path, output: Path) -> Failure | None:
+		assert self.proc.stdin is not None and self.proc.stdout is not None
+		stderr_start = os.fstat(self.stderr.fileno()).st_size
+		try:
+			_ = self.proc.stdin.write(f"{input}\t{output}\n".encode())
+			self.proc.stdin.flush()
+		except BrokenPipeError:
+			pass
+		status = self.proc.stdout.readline().decode()
+		if status == "ok\n":
 			return None
-	except subprocess.TimeoutExpired:
-		return TimeoutFailure(str(args[0]), -1 if timeout is None else timeout)
+		elif status.startswith("error "):
+			message = self.proc.stdout.read(int(status.removeprefix("error ")))
+			return CodegenFailure(message.decode(errors="replace"))
+		else:
+			# The server died without reporting anything
+			code = self.proc.wait()
+			_ = self.stderr.seek(stderr_start)
+			return StatusCodeFailure(str(self.binary), code, b"", self.stderr.read())
+
+	def is_alive(self) -> bool:
+		return self.proc.poll() is None
+
+	def close(self) -> None:
+		assert self.proc.stdin is not None
+		self.proc.stdin.close()
+		_ = self.proc.wait()
+		self.stderr.close()
+
+class CodegenPool:
+	"""
+	Compiles bitcode using a pool of codegen servers. The codegen gets built before the first server is started.
+	"""
+	lock: threading.Lock
+	binary: Path | Failure | None
+	servers: SessionPool[CodegenServer] | None
+
+	def __init__(self) -> None:
+		self.lock = threading.Lock()
+		self.binary = None
+		self.servers = None
+
+	def build(self) -> Path | Failure:
+		"""
+		Builds the codegen, and asks cargo where it put the binary. It won't be in target/debug if a different
+		target dir is configured. Compile errors are still rendered as text on stderr, so they stay readable.
+		"""
+		r = exec([
+			CARGO,
+			"build",
+			"--quiet",
+			"--message-format=json-render-diagnostics",
+			"--bin",
+			"jvlm"
+		], return_output=True, cwd=(mainDir / ".."))
+		if isinstance(r, Failure):
+			return r
+		for line in r.splitlines():
+			if not line.startswith("{"):
+				continue
+			message = json.loads(line)
+			if message.get("reason") == "compiler-artifact" and message["target"]["name"] == "jvlm" and message.get("executable") is not None:
+				return Path(message["executable"])
+		return CodegenFailure("cargo build did not report where the jvlm binary is")
+
+	def compile(self, input: Path, output: Path) -> Failure | None:
+		with self.lock:
+			if self.binary is None:
+				self.binary = self.build()
+			binary = self.binary
+			if isinstance(binary, Failure):
+				return binary
+			if self.is_up_to_date(binary, input, output):
+				return None
+			if self.servers is None:
+				self.servers = SessionPool(lambda: CodegenServer(binary))
+			servers = self.servers
+
+		try:
+			with servers.session() as server:
+				r = server.compile(input, output)
+		except OSError as e:
+			return CodegenFailure(f"Could not start {binary}: {e}")
+		if r is not None:
+			# Don't leave a half-written jar around, it would look up to date next time
+			output.unlink(missing_ok=True)
+		return r
+
+	def is_up_to_date(self, binary: Path, input: Path, output: Path) -> bool:
+		"""
+		Like make, checks if the output is newer than both the input and the codegen binary itself.
+		"""
+		try:
+			built = output.stat().st_mtime_ns
+			return built >= input.stat().st_mtime_ns and built >= binary.stat().st_mtime_ns
+		except FileNotFoundError:
+			return False
+
+	def close(self) -> None:
+		if self.servers is not None:
+			self.servers.close()
+
+codegen = CodegenPool()
+
+class JShellSession:
+	"""
+	A jshell process which is kept around to run multiple tests. The jar of each test is put on the class path
+	using `/reset`, which only restarts the execution engine instead of all of jshell.
+	"""
+	proc: subprocess.Popen[bytes]
+	buffer: bytearray
+	test_id: int
+
+	def __init__(self) -> None:
+		self.proc = subprocess.Popen([JSHELL, "--enable-preview", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.buffer = bytearray()
+		self.test_id = 0
+
+	def run(self, jar: Path, run_str: str, timeout: float) -> str | Failure:
+		"""
+		Prints the result of evaluating run_str, and returns all output. The output of this run is told apart from
+		the rest by printing markers around it.
+		"""
+		assert self.proc.stdin is not None
+		deadline = time.monotonic() + timeout
+		self.test_id += 1
+		marker = f"jvlm-test-{self.test_id}"
+		# jshell splits command arguments on whitespace, unless they're quoted
+		class_path = '"' + str(jar).replace("\\", "\\\\").replace('"', '\\"') + '"'
+		try:
+			_ = self.proc.stdin.write(f"/reset -class-path {class_path}\nSystem.out.println(\"{marker}-start\")\nSystem.out.println({run_str})\nSystem.out.println(\"{marker}-end\")\n".encode())
+			self.proc.stdin.flush()
+			_ = self.read_until(f"{marker}-start\n".encode(), deadline)
+			return self.read_until(f"{marker}-end\n".encode(), deadline).decode(errors="replace")
+		except TimeoutError:
+			# jshell won't read any commands until the test is done running, so the process has to go
+			self.proc.kill()
+			_ = self.proc.wait()
+			return TimeoutFailure(JSHELL, timeout)
+		except (EOFError, BrokenPipeError):
+			return StatusCodeFailure(JSHELL, self.proc.wait(), bytes(self.buffer), b"")
+
+	def read_until(self, token: bytes, deadline: float) -> bytes:
+		assert self.proc.stdout is not None
+		fd = self.proc.stdout.fileno()
+		while (i := self.buffer.find(token)) < 0:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or len(select.select([fd], [], [], remaining)[0]) == 0:
+				raise TimeoutError()
+			chunk = os.read(fd, 65536)
+			if len(chunk) == 0:
+				raise EOFError()
+			self.buffer += chunk
+		data = bytes(self.buffer[:i])
+		del self.buffer[:i+len(token)]
+		return data
+
+	def is_alive(self) -> bool:
+		return self.proc.poll() is None
+
+	def close(self) -> None:
+		assert self.proc.stdin is not None
+		self.proc.stdin.close()
+		_ = self.proc.wait()
+
+# Starting the JVM for jshell takes a lot longer than most tests do, so sessions are reused for the next test
+jshell_sessions = SessionPool(JShellSession)
 
 class Language(ABC):
 	name: str
 	base_dir: Path
+	# Tests of languages that can't be compiled into a jar yet are left out of the jar, javap and test modes
+	compiles_jars: bool = True
+	_valid_tests: frozenset[str] | None
 
-	def initialize(self, name: str, mainDir: Path):
+	def initialize(self, name: str, mainDir: Path) -> None:
 		self.name = name
 		self.base_dir = mainDir / self.name
+		self._valid_tests = None
+
+	def is_test(self, segment: str) -> bool:
+		"""
+		Checks if a (normalized) segment is one of the tests listed by list_all_tests. The listing only
+		happens once, so checking many segments doesn't hit the filesystem for each one.
+		"""
+		if self._valid_tests is None:
+			self._valid_tests = frozenset(self.list_all_tests())
+		return segment in self._valid_tests
 
 	@abstractmethod
 	def normalize_test_segment(self, test: str) -> str | None:
@@ -142,22 +456,30 @@ class Language(ABC):
 		list(CLanguage().list_all_tests()) == ["example.c", "example2.c"]
 		"""
 		...
+	def precompile(self, segments: list[str]) -> None:
+		"""
+		Called with all the segments that are about to be passed to compileJar, so work can be shared
+		between them. Does nothing by default.
+		"""
+		pass
 	@abstractmethod
 	def compileJar(self, segment: str) -> Path | Failure:
 		...
 	@abstractmethod
-	def showLlvmir(self, segment: str):
+	def compileLlvmir(self, segment: str) -> str | Failure:
 		...
 	@abstractmethod
 	def get_tests_declaration(self, segment: str) -> str:
 		...
 
 class RustLanguage(Language):
+	compiles_jars = False
+
 	@override
 	def normalize_test_segment(self, test: str) -> str | None:
 		# We don't support nested directories yet
 		normalized_test = test.split("/")[0]
-		if (self.base_dir / normalized_test / "Cargo.toml").exists():
+		if self.is_test(normalized_test):
 			return normalized_test
 		else:
 			return None
@@ -166,18 +488,42 @@ class RustLanguage(Language):
 		if dir != "":
 			# No support for nested directories yet, which means that any non-root path cannot have tests
 			return []
-		return (f"{f}" for f in os.listdir(self.base_dir) if (self.base_dir / f / "Cargo.toml").exists())
+		return self._tests
+	@cached_property
+	def _tests(self) -> list[str]:
+		# Each directory with a Cargo.toml is a test. The entries from scandir already know whether they're
+		# a directory, so this only needs to hit the filesystem once per directory
+		with os.scandir(self.base_dir) as entries:
+			return [e.name for e in entries if e.is_dir() and os.access(os.path.join(e.path, "Cargo.toml"), os.F_OK)]
 	@override
 	def compileJar(self, segment: str) -> Path | Failure:
-		...
+		return UnsupportedFailure("Compiling Rust tests into a jar")
 	@override
-	def showLlvmir(self, segment: str):
-		...
+	def compileLlvmir(self, segment: str) -> str | Failure:
+		# Not supported yet, so there's no IR to show
+		return ""
 	@override
 	def get_tests_declaration(self, segment: str) -> str:
 		return ""
 
+C_DECLARATION_RE = re.compile(b"/\\*(.*?)\\*/", re.DOTALL)
+C_COMPILE_FLAGS_RE = re.compile("^compile\\s(.*)$", re.MULTILINE)
+
 class CLanguage(Language):
+	# These get requested multiple times per test, so they're cached per segment
+	_declarations: dict[str, str]
+	_compile_flags: dict[str, list[str]]
+	_test_lists: dict[tuple[str, bool], list[str]]
+	out_dir: Path
+
+	@override
+	def initialize(self, name: str, mainDir: Path) -> None:
+		super().initialize(name, mainDir)
+		self.out_dir = mainDir / "out" / self.name
+		self._declarations = {}
+		self._compile_flags = {}
+		self._test_lists = {}
+
 	@override
 	def normalize_test_segment(self, test: str) -> str | None:
 		# Common extensions for non-tests which might accidentally end up in the test directory
@@ -186,61 +532,170 @@ class CLanguage(Language):
 		if not test.endswith(".c"):
 			# Tests for this language should end with .c, try appending one
 			test = f"{test}.c"
-		return test if (self.base_dir / test).exists() else None
+		return test if self.is_test(test) else None
 
 	@override
 	def list_all_tests(self, dir: str = "", recurse: bool = True) -> Iterable[str]:
-		return (f"{f}" for f in glob.glob("**/*.c" if recurse else "*.c", root_dir=(self.base_dir / dir), recursive=recurse))
+		tests = self._test_lists.get((dir, recurse))
+		if tests is None:
+			tests = list(self.walk_tests(dir, recurse))
+			self._test_lists[(dir, recurse)] = tests
+		return tests
+
+	def walk_tests(self, dir: str, recurse: bool) -> Iterator[str]:
+		try:
+			entries = os.scandir(self.base_dir / dir)
+		except FileNotFoundError:
+			return
+		with entries:
+			for entry in entries:
+				# Hidden files are skipped, like glob would
+				if entry.name.startswith("."):
+					continue
+				if entry.is_dir():
+					if recurse:
+						yield from self.walk_tests(os.path.join(dir, entry.name), recurse)
+				elif entry.name.endswith(".c"):
+					yield os.path.join(dir, entry.name)
 
 	@override
 	def get_tests_declaration(self, segment: str) -> str:
-		input_file = self.base_dir / segment
-		return next(re.finditer("/\\*(.*)\\*/", input_file.read_text(), re.MULTILINE | re.DOTALL)).group(1)
+		declaration = self._declarations.get(segment)
+		if declaration is None:
+			declaration = self.read_declaration(self.base_dir / segment)
+			self._declarations[segment] = declaration
+		return declaration
+
+	def read_declaration(self, input_file: Path) -> str:
+		# The declaration is the comment at the start of the file, there's no need to read all the code after it
+		with open(input_file, "rb") as f:
+			data = f.read(8192)
+			while True:
+				m = C_DECLARATION_RE.search(data)
+				if m is not None:
+					return m.group(1).decode()
+				more = f.read(len(data))
+				if len(more) == 0:
+					return ""
+				data += more
 
 	def get_compile_flags(self, segment: str) -> list[str]:
-		# tests declaration also includes compiler flags
-		cflags = next(re.finditer("^compile\\s(.*)$", self.get_tests_declaration(segment), re.MULTILINE)).group(1)
-		cflags = ("" if not isinstance(cflags, str) else cflags)
-		cflags = cflags.split(" ")
+		cflags = self._compile_flags.get(segment)
+		if cflags is None:
+			# tests declaration also includes compiler flags
+			m = C_COMPILE_FLAGS_RE.search(self.get_tests_declaration(segment))
+			cflags = m.group(1).split(" ") if m is not None else []
+			self._compile_flags[segment] = cflags
 		return cflags
 
+	def bitcode_file(self, segment: str) -> Path:
+		# normalize_test_segment guarantees that segments end in .c
+		return self.out_dir / f"{segment[:-2]}.bc"
+
+	def bitcode_key(self, segment: str) -> str:
+		"""
+		Hash of everything that goes into the .bc file of a test. It's stored next to the .bc file,
+		so that clang can be skipped when nothing changed, similar to what ccache does.
+		"""
+		h = hashlib.blake2b()
+		h.update(" ".join(self.get_compile_flags(segment)).encode())
+		h.update(b"\0")
+		h.update((self.base_dir / segment).read_bytes())
+		return h.hexdigest()
+
+	def is_bitcode_current(self, segment: str) -> bool:
+		"""
+		Like make, the .bc file is up to date if it's newer than the source and was built with the same flags.
+		If the source is newer, the hash decides instead, so just touching a file doesn't cause a rebuild.
+		"""
+		tmp_file = self.bitcode_file(segment)
+		try:
+			(flags, key) = tmp_file.with_suffix(".bc.hash").read_text().split("\n", 1)
+			if flags != " ".join(self.get_compile_flags(segment)):
+				return False
+			if tmp_file.stat().st_mtime_ns >= (self.base_dir / segment).stat().st_mtime_ns:
+				return True
+		except (FileNotFoundError, ValueError):
+			return False
+		return key == self.bitcode_key(segment)
+
+	def mark_bitcode_current(self, segment: str, key: str) -> None:
+		_ = self.bitcode_file(segment).with_suffix(".bc.hash").write_text(f"{" ".join(self.get_compile_flags(segment))}\n{key}")
+
+	@override
+	def precompile(self, segments: list[str]) -> None:
+		# Starting up clang is a good chunk of the time spent on a small test. The clang driver accepts
+		# multiple inputs at once, as long as they share flags. It writes the outputs into the working
+		# directory, so tests are also batched per directory.
+		batches: dict[tuple[str, tuple[str, ...]], list[tuple[str, str]]] = {}
+		for segment in segments:
+			if self.is_bitcode_current(segment):
+				continue
+			key = (os.path.dirname(segment), tuple(self.get_compile_flags(segment)))
+			batches.setdefault(key, []).append((segment, self.bitcode_key(segment)))
+
+		# A single clang process compiles its inputs one after another. So big batches are split up again
+		# to keep every core busy, but each part still gets at least two inputs to share the startup cost
+		jobs = os.cpu_count() or 1
+		chunks: list[tuple[str, tuple[str, ...], list[tuple[str, str]]]] = []
+		for ((dir, flags), batch) in batches.items():
+			size = max(2, -(-len(batch) // jobs))
+			chunks.extend((dir, flags, batch[i:i+size]) for i in range(0, len(batch), size))
+
+		def compile_chunk(dir: str, flags: tuple[str, ...], chunk: list[tuple[str, str]]) -> None:
+			if len(chunk) < 2:
+				return
+			out_dir = self.out_dir / dir
+			out_dir.mkdir(parents=True, exist_ok=True)
+			r = exec([
+				CLANG,
+				*flags,
+				"-emit-llvm",
+				"-c",
+			] + [self.base_dir / s for (s, _) in chunk], cwd=out_dir)
+			# If the batch fails, compileJar will compile these tests one by one, which results in
+			# a proper error for the broken test
+			if r is None:
+				for (s, bitcode_key) in chunk:
+					self.mark_bitcode_current(s, bitcode_key)
+
+		with ThreadPoolExecutor(max_workers=jobs) as pool:
+			for f in [pool.submit(compile_chunk, *c) for c in chunks]:
+				f.result()
+
 	@override
 	def compileJar(self, segment: str) -> Path | Failure:
 		input_file = self.base_dir / segment
-		tmp_file = mainDir / "out" / "c" / (segment.removesuffix(".c")+".bc")
+		tmp_file = self.bitcode_file(segment)
 		tmp_file.parent.mkdir(parents=True, exist_ok=True)
 
-		r = exec([
-			CLANG,
-		] + self.get_compile_flags(segment) + [
-			"-emit-llvm",
-			"-c",
-			input_file,
-			"-o",
-			tmp_file
-		])
+		if not self.is_bitcode_current(segment):
+			bitcode_key = self.bitcode_key(segment)
+			r = exec([
+				CLANG,
+			] + self.get_compile_flags(segment) + [
+				"-emit-llvm",
+				"-c",
+				input_file,
+				"-o",
+				tmp_file
+			])
 
-		if r != None:
-			return r
+			if r != None:
+				return r
+			self.mark_bitcode_current(segment, bitcode_key)
 
-		jar_file = mainDir / "out" / "c" / (segment.removesuffix(".c")+".jar")
-		r = exec([
-			CARGO,
-			"run",
-			"--quiet",
-			"--",
-			tmp_file,
-			jar_file
-		], cwd=(mainDir / ".."))
+		jar_file = tmp_file.with_suffix(".jar")
+		r = codegen.compile(tmp_file, jar_file)
 
 		if r != None:
 			return r
 		return jar_file
 
 	@override
-	def showLlvmir(self, segment: str):
+	def compileLlvmir(self, segment: str) -> str | Failure:
 		input_file = self.base_dir / segment
-		_ = subprocess.check_call([
+		return exec([
 			CLANG,
 		] + self.get_compile_flags(segment) + [
 			"-S",
@@ -249,7 +704,7 @@ class CLanguage(Language):
 			input_file,
 			"-o",
 			"-"
-		])
+		], return_output=True, forward_stderr=True)
 
 languages = {
 	"c": CLanguage(),
@@ -259,49 +714,56 @@ for (k,v) in languages.items():
 	v.initialize(k, mainDir)
 
 
+TEST_DIRECTIVE_RE = re.compile("^(java_run|expect_timeout|expect_contains|expect)(.*)$", re.MULTILINE)
+
 def parse_test_declaration(declaration: str) -> list[Callable[[Path], Failure | None]]:
 	tests: list[Callable[[Path], Failure | None]] = []
-	lines = declaration.splitlines()
-	i = 0
-	while i < len(lines):
-		cLine = lines[i]
-		if cLine.startswith("java_run"):
-			run_str = cLine.removeprefix("java_run").strip()
-			nLine = lines[i+1]
-			if nLine.startswith("expect_timeout"):
-				expect = nLine.removeprefix("expect_timeout").removeprefix("expect_timeout").strip()
-				if not expect.endswith("seconds"):
-					raise Exception("Invalid syntax for expect_timeout")
-				timeout = float(expect.removesuffix("seconds").strip())
-				def run_test(p: Path) -> Failure | None:
-					try:
-						_ = subprocess.run([JSHELL, "--enable-preview", "-c", p, "-"], capture_output=True, input=f"System.out.println({run_str})".encode(), timeout=timeout)
-						return NoTimeoutFailure(timeout)
-					except subprocess.TimeoutExpired:
-						return None
-				tests.append(run_test)
-			elif nLine.startswith("expect"):
-				contains = nLine.startswith("expect_contains")
-				if contains:
-					expect = nLine.removeprefix("expect_contains").strip()
-				else:
-					expect = nLine.removeprefix("expect").strip()
-				def run_test(p: Path) -> Failure | None:
-					r = exec([JSHELL, "--enable-preview", "-c", p, "-"], input=f"System.out.println({run_str})", return_output=True, timeout=300)
-					if isinstance(r, Failure):
-						return r
-					else:
-						if (not contains and r.strip() != expect) or (contains and (not expect in r.strip())):
-							return AssertFailure(expect, r.strip())
-						else:
-							return None
-				tests.append(run_test)
-			else:
+	# Every java_run needs to be followed by an expectation
+	run_str: str | None = None
+	for directive in TEST_DIRECTIVE_RE.finditer(declaration):
+		(kind, arg) = (directive.group(1), directive.group(2).strip())
+		if kind == "java_run":
+			if run_str is not None:
 				raise Exception("java_run has no expect")
-		i += 1
+			run_str = arg
+		elif run_str is not None:
+			match kind:
+				case "expect_timeout":
+					if not arg.endswith("seconds"):
+						raise Exception("Invalid syntax for expect_timeout")
+					tests.append(expect_timeout_test(run_str, float(arg.removesuffix("seconds").strip())))
+				case "expect_contains":
+					tests.append(expect_output_test(run_str, arg, contains=True))
+				case _:
+					tests.append(expect_output_test(run_str, arg, contains=False))
+			run_str = None
+	if run_str is not None:
+		raise Exception("java_run has no expect")
 	return tests
 
-def main():
+def expect_timeout_test(run_str: str, timeout: float) -> Callable[[Path], Failure | None]:
+	def run_test(p: Path) -> Failure | None:
+		with jshell_sessions.session() as session:
+			r = session.run(p, run_str, timeout)
+		if isinstance(r, TimeoutFailure):
+			return None
+		return NoTimeoutFailure(timeout)
+	return run_test
+
+def expect_output_test(run_str: str, expect: str, contains: bool) -> Callable[[Path], Failure | None]:
+	def run_test(p: Path) -> Failure | None:
+		with jshell_sessions.session() as session:
+			r = session.run(p, run_str, 300)
+		if isinstance(r, Failure):
+			return r
+		else:
+			if (not contains and r.strip() != expect) or (contains and (not expect in r.strip())):
+				return AssertFailure(expect, r.strip())
+			else:
+				return None
+	return run_test
+
+def main() -> None:
 	if len(sys.argv) <= 1:
 		print(f"Usage: {sys.argv[0]} <mode> [tests...]")
 		sys.exit(1)
@@ -322,73 +784,87 @@ def main():
 			sys.exit(1)
 
 	# Plan out which tests we need to operate on
-	tests: Iterable[tuple[Language, str]]
+	tests: list[tuple[Language, str]]
 	if len(sys.argv[2:]) == 0:
-		tests = ((l, test) for (l) in languages.values() for test in l.list_all_tests())
+		tests = [(l, test) for (l) in languages.values() for test in l.list_all_tests()]
 	else:
+		def split_lang(arg: str) -> tuple[Language | None, str]:
+			"""
+			Splits an argument into its language and the part of the name after the lang, based on the first directory
+			"""
+			(head, _, segment) = arg.partition("/")
+			if head == "":
+				(head, _, segment) = segment.partition("/")
+			return (languages.get(head), segment)
+
 		def a() -> Iterable[tuple[Language, str]]:
-			weird_dir = Path(".").absolute() != mainDir # If true, the arguments might be relative to pwd
+			cwd = Path.cwd()
+			weird_dir = cwd != mainDir # If true, the arguments might be relative to pwd
 			for arg in sys.argv[2:]:
 				if arg.startswith("./"):
 					arg = arg[2:]
-				lang = None
-				for candidate in languages.keys():
-					if arg.startswith(candidate) or arg.startswith("/"+candidate):
-						lang = candidate
-						break
-				if lang is None and weird_dir and Path(arg).exists():
-					arg = str(Path(arg).absolute().relative_to(mainDir, walk_up=True))
-					for candidate in languages.keys():
-						if arg.startswith(candidate) or arg.startswith("/"+candidate):
-							lang = candidate
-							break
-				if lang is not None:
-					# The part of the name after the lang
-					segment = arg[len(lang):]
-					l = languages[lang]
-					if segment == "" or segment == "/":
+				(l, segment) = split_lang(arg)
+				if l is None and weird_dir:
+					try:
+						# Fails if the file doesn't exist, in which case it can't be a test relative to pwd either
+						arg = str((cwd / arg).resolve(strict=True).relative_to(mainDir, walk_up=True))
+						(l, segment) = split_lang(arg)
+					except OSError:
+						pass
+				if l is not None:
+					if segment == "":
 						# That means to just run all the tests of the lang
 						yield from ((l, s) for s in l.list_all_tests())
+					# Support basic glob syntax
+					elif segment.endswith("**/*"):
+						segment = segment.removesuffix("**/*")
+						yield from ((l, s) for s in l.list_all_tests(dir=segment, recurse=True))
+					elif segment.endswith("*"):
+						segment = segment.removesuffix("*")
+						yield from ((l, s) for s in l.list_all_tests(dir=segment, recurse=False))
 					else:
-						if segment.startswith("/"):
-							segment = segment.removeprefix("/")
-							# Support basic glob syntax
-							if segment.endswith("**/*"):
-								segment = segment.removesuffix("**/*")
-								yield from ((l, s) for s in l.list_all_tests(dir=segment, recurse=True))
-							elif segment.endswith("*"):
-								segment = segment.removesuffix("*")
-								yield from ((l, s) for s in l.list_all_tests(dir=segment, recurse=False))
-							else:
-								segment = l.normalize_test_segment(segment)
-								if segment is not None:
-									yield (l, segment)
-						else:
-							# No /, that means the arg was something like "rustabcdefg", which is invalid
-							# Just ignore that
-							pass
-		tests = unique(a())
+						normalized = l.normalize_test_segment(segment)
+						if normalized is not None:
+							yield (l, normalized)
+		# Removes duplicates, while keeping the order
+		tests = list(dict.fromkeys(a()))
 
 	def do_jar(tests: Iterable[tuple[Language, str]]) -> Iterable[tuple[tuple[Language, str], Path | Failure]]:
-		for (l, s) in tests:
-			v = l.compileJar(s)
-			if isinstance(v, Failure):
-				yield ((l,s),CompileFailure(l.name, s, v))
-			else:
-				yield ((l,s),v)
+		# Each test compiles independently, and almost all of the time is spent waiting on clang and cargo.
+		# So let them overlap, while still yielding the results in order
+		tests = [(l, s) for (l, s) in tests if l.compiles_jars]
+		for l in languages.values():
+			l.precompile([s for (tl, s) in tests if tl is l])
+		with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+			futures = [pool.submit(l.compileJar, s) for (l, s) in tests]
+			for ((l, s), f) in zip(tests, futures):
+				v = f.result()
+				if isinstance(v, Failure):
+					yield ((l,s),CompileFailure(l.name, s, v))
+				else:
+					yield ((l,s),v)
+		codegen.close()
 	
 	# Alrighty, we know which tests to operate on now
+	failures: list[Failure] = []
 	match mode:
 		case "dry_run":
 			print(list(f"{l.name}/{s}" for (l, s) in tests))
 			pass
 		case "show_ir":
-			for (l, s) in tests:
-				l.showLlvmir(s)
+			# Clang runs are independent, so run them all at once, but print them in order
+			with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+				for ((l, s), ir) in zip(tests, pool.map(lambda t: t[0].compileLlvmir(t[1]), tests)):
+					if isinstance(ir, Failure):
+						failures.append(CompileFailure(l.name, s, ir))
+					else:
+						print(ir, end="")
+			for f in failures:
+				print(f"!! {f.full_err()}")
+			sys.exit(2 if len(failures) > 0 else 0)
 		case "javap":
 			import zipfile
 			jars: list[Path] = []
-			failures: list[Failure] = []
 			for (_, j) in do_jar(tests):
 				if isinstance(j, Failure):
 					failures.append(j)
@@ -398,14 +874,14 @@ def main():
 				for f in failures:
 					print(f"!! {f.short_err()}")
 				sys.exit(2)
-			classes: list[str] = []
-			for jar in jars:
-				z = ZipFile(jar)
-				for cl in z.filelist:
-					classes.append(f"jar:{jar.as_uri()}!/{cl.filename}")
+			def list_classes(jar: Path) -> list[str]:
+				with ZipFile(jar) as z:
+					return [f"jar:{jar.as_uri()}!/{cl.filename}" for cl in z.filelist]
+			# Reading the central directory of each jar is just waiting on IO, so do them all at once
+			with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+				classes = [c for jar_classes in pool.map(list_classes, jars) for c in jar_classes]
 			sys.exit(subprocess.check_call(["javap", "-c"] + classes))
 		case "jar":
-			failures: list[Failure] = []
 			for (_, j) in do_jar(tests):
 				if isinstance(j, Failure):
 					failures.append(j)
@@ -418,35 +894,43 @@ def main():
 					print(f"!! {f.short_err()}")
 			sys.exit(2 if len(failures) > 0 else 0)
 		case "test":
-			failures: list[Failure] = []
-			for (tst, j) in do_jar(tests):
-				if isinstance(j, Failure):
-					failures.append(j)
-				else:
-					# test declaration contains which tests to do
-					test_declaration = tst[0].get_tests_declaration(tst[1])
-					test_runners = parse_test_declaration(test_declaration)
-					anyfail = False
-					for r in test_runners:
-						result = r(j)
-						if result is not None:
-							failures.append(TestFailure(tst[0].name, tst[1], result))
-							anyfail = True
-					if not anyfail:
-						print(f"{tst[0].name}/{tst[1]}: Success on {len(test_runners)} tests")
+			def run_tests(tst: tuple[Language, str], j: Path) -> tuple[int, list[Failure]]:
+				# test declaration contains which tests to do
+				test_declaration = tst[0].get_tests_declaration(tst[1])
+				test_runners = parse_test_declaration(test_declaration)
+				test_failures: list[Failure] = []
+				for r in test_runners:
+					result = r(j)
+					if result is not None:
+						test_failures.append(TestFailure(tst[0].name, tst[1], result))
+				return (len(test_runners), test_failures)
+
+			# Running the tests is mostly spent waiting on jshell, so they can overlap as well. They're
+			# started as soon as their jar is ready
+			with ThreadPoolExecutor(max_workers=JSHELL_JOBS) as pool:
+				runs = {tst: j if isinstance(j, Failure) else pool.submit(run_tests, tst, j) for (tst, j) in do_jar(tests)}
+				for tst in tests:
+					run = runs.get(tst)
+					if run is None:
+						# There's no jar to test, which is only fine as long as there's nothing to run on it
+						test_count = len(parse_test_declaration(tst[0].get_tests_declaration(tst[1])))
+						if test_count > 0:
+							failures.append(CompileFailure(tst[0].name, tst[1], UnsupportedFailure(f"Compiling {tst[0].name} tests into a jar")))
+						else:
+							print(f"{tst[0].name}/{tst[1]}: Success on 0 tests")
+					elif isinstance(run, Failure):
+						failures.append(run)
+					else:
+						(test_count, test_failures) = run.result()
+						failures.extend(test_failures)
+						if len(test_failures) == 0:
+							print(f"{tst[0].name}/{tst[1]}: Success on {test_count} tests")
+			jshell_sessions.close()
 			if len(failures) == 1:
 				print(f"!! {failures[0].full_err()}")
 			elif len(failures) > 1:
 				for f in failures:
 					print(f"!! {f.short_err()}")
 
-T = TypeVar('T')
-def unique(iter: Iterable[T]) -> Iterable[T]:
-	s: set[T] = set()
-	for n in iter:
-		if not (n in s):
-			yield n
-			s.add(n)
-
 if __name__ == "__main__":
 	main()
\ No newline at end of file